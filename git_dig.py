@@ -2,55 +2,30 @@
 
 
 import os
+import re
 import sys
+import threading
+from bisect import bisect_right
 from collections import defaultdict
-from collections.abc import MutableSet
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from itertools import chain
 from subprocess import DEVNULL, PIPE, CalledProcessError, Popen, run
 
 import click
 from colorama import Fore, init  # type: ignore
 
 _devnull = DEVNULL
-_verbose = False
+_print_lock = threading.Lock()
 
 
-class OrderedSet(MutableSet):
-    def __init__(self):
-        self.data = dict()
-
-    def add(self, elem):
-        self.data[elem] = None
-
-    def discard(self, elem):
-        try:
-            self.data.pop(elem)
-        except KeyError:
-            pass
-
-    def __contains__(self, elem):
-        return self.data.__contains__(elem)
-
-    def __len__(self):
-        return self.data.__len__()
-
-    def __iter__(self):
-        keys = self.data.keys()
-
-        def iter_func():
-            for key in keys:
-                yield key
-
-        return iter_func()
-
-
-a = OrderedSet()
-
-
-def vprint(msg):
-    """Print in verbose only."""
-    if _verbose:
+def print_verbose(msg):
+    """Print verbose output."""
+    if isinstance(msg, str):
+        msg = msg.encode("UTF-8", errors="surrogateescape")
+    msg = msg.decode("UTF-8", errors="backslashreplace").rstrip("\n")
+    with _print_lock:
         print(Fore.CYAN + f"> {msg}" + Fore.RESET)
 
 
@@ -59,41 +34,41 @@ def wprint(msg):
     print(Fore.RED + f"! {msg}" + Fore.RESET, file=sys.stderr)
 
 
-@contextmanager
-def chdir(path):
-    """Contextmanager to change directory."""
-    cwd = os.getcwd()
-    os.chdir(path)
-    vprint(f"change dir {path}")
-    yield
-    os.chdir(cwd)
-    vprint(f"restore dir {cwd}")
-
-
-def args_print(args):
+def print_args(args):
     """Print args of executed command."""
-    if _verbose:
-        args = [str(x) for x in args]
-        args = " ".join(args)
+    args = [str(x) for x in args]
+    args = " ".join(args)
+    with _print_lock:
         print(Fore.GREEN + f"$ {args}" + Fore.RESET)
 
 
+def print_nothing(_):
+    """Print nothing, used for verbose output if not verbose."""
+
+
+# main() binds these to print_verbose and print_args in verbose mode, so the
+# hot call sites do not have to check for verbose mode
+vprint = print_nothing
+args_print = print_nothing
+
+
 class SPopen(Popen):
     """Inject defaults into Popen."""
 
-    def __init__(self, *args, stderr=None, stdin=None, **kwargs):
+    def __init__(self, *args, stderr=None, stdin=None, encoding="UTF-8", **kwargs):
         """Inject default into Popen."""
         args_print(args[0])
         if stderr is None:
             stderr = _devnull
         if stdin is None and "input" not in kwargs:
             stdin = _devnull
+        if encoding:
+            kwargs["errors"] = "surrogateescape"
         super().__init__(
             *args,
             stderr=stderr,
             stdin=stdin,
-            encoding="UTF-8",
-            errors="backslashreplace",
+            encoding=encoding,
             **kwargs,
         )
 
@@ -113,7 +88,7 @@ def srun(*args, stdout=None, stderr=None, stdin=None, **kwargs):
         stderr=stderr,
         stdin=stdin,
         encoding="UTF-8",
-        errors="backslashreplace",
+        errors="surrogateescape",
         **kwargs,
     )
 
@@ -139,7 +114,7 @@ def diff(parent, child=None):
         child = []
     else:
         child = [child]
-    with popen(["git", "diff", "--unified=1", parent] + child, stdout=PIPE) as proc:
+    with popen(["git", "diff", "--unified=0", parent] + child, stdout=PIPE) as proc:
         yield proc
 
 
@@ -161,196 +136,317 @@ def blame(rev, path):
         rev = []
     else:
         rev = [rev]
-    with popen(["git", "blame", "-s"] + rev + ["--", path], stdout=PIPE) as proc:
+    with popen(
+        ["git", "blame", "--incremental"] + rev + ["--", path],
+        stdout=PIPE,
+        encoding=None,
+    ) as proc:
         yield proc
 
 
-def print_depend(rev, depth=0, is_seen=False):
+class CatFile:
+    """Long-running git cat-file to resolve many revs with one process."""
+
+    def __init__(self):
+        """Create a cat-file, the process is started on enter."""
+        self.proc = None
+        self.abbrev = None
+
+    def __enter__(self):
+        """Start git cat-file."""
+        # Abbreviate like git does, it follows core.abbrev and the repo size
+        res = srun(["git", "rev-parse", "--short", "HEAD"], stdout=PIPE, check=True)
+        self.abbrev = len(res.stdout.strip())
+        self.proc = SPopen(
+            ["git", "cat-file", "--batch"],
+            stdin=PIPE,
+            stdout=PIPE,
+            encoding=None,
+        )
+        return self
+
+    def __exit__(self, *exc_info):
+        """Stop git cat-file."""
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.wait()
+
+    def resolve(self, rev):
+        """Resolve rev to a oneline description."""
+        stdin = self.proc.stdin
+        stdout = self.proc.stdout
+        stdin.write(f"{rev}\n".encode("UTF-8"))
+        stdin.flush()
+        header = stdout.readline().decode("UTF-8", errors="backslashreplace")
+        name, _, rest = header.strip().partition(" ")
+        if rest in ("missing", "ambiguous"):
+            raise CalledProcessError(128, ["git", "cat-file", "--batch", rev])
+        _, _, size = rest.partition(" ")
+        # The object is followed by a newline
+        content = stdout.read(int(size) + 1)
+        content = content.decode("UTF-8", errors="backslashreplace")
+        _, _, message = content.partition("\n\n")
+        subject, _, _ = message.strip().partition("\n\n")
+        subject = " ".join(subject.split("\n"))
+        return Fore.YELLOW + name[: self.abbrev] + Fore.RESET + f" {subject}"
+
+
+def print_depend(catfile, rev, depth=0, is_seen=False):
     """Print out depend."""
     indent = ""
     if depth:
         indent = "    " * depth
-    res = srun(
-        ["git", "show", "--color=always", "--quiet", "--oneline"] + [rev],
-        stdout=PIPE,
-        check=True,
-    )
+    oneline = catfile.resolve(rev)
     seen = ""
     if is_seen:
         seen = "(already followed)"
-    print(f"{indent}{res.stdout.strip()} " + Fore.GREEN + seen + Fore.RESET)
-
+    print(f"{indent}{oneline} " + Fore.GREEN + seen + Fore.RESET)
 
-def linereader(stream):
-    """Read lines from stream."""
-    while True:
-        line = stream.readline()
-        if not line:
-            return
-        line = line.strip("\n")
-        vprint(line)
-        yield line
 
-
-def parse_hunk_field(field):
-    """Parse a hunk field."""
-    field = [int(i) for i in field[1:].split(",")]
-    if len(field) < 2:
-        field.append(1)
-        assert len(field) == 2
-    return tuple(field)
+_hunk_header = re.compile(r"@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
 
 
 @dataclass(slots=True, frozen=True)
 class Hunk:
     """Defines a hunk."""
 
-    deps: OrderedSet[str]
+    deps: dict[str, None]
     parent: str
     child: str
     path: str
     first: tuple[int, int]
     second: tuple[int, int]
-    hint: str
-    line: str
 
     @classmethod
     def from_line(cls, parent, child, path, line):
         """Create a unk from a line."""
-        data = [data.strip() for data in line.split("@@") if data]
-        first, _, second = data[0].partition(" ")
-        first = parse_hunk_field(first)
-        second = parse_hunk_field(second)
-        hint = ""
-        if len(data) > 1:
-            hint = data[1]
-
-        return cls(OrderedSet(), parent, child, path, first, second, hint, line)
+        match = _hunk_header.match(line)
+        if match is None:
+            raise ValueError(f"cannot parse hunk header: {line!r}")
+        first = (int(match[1]), int(match[2] or 1))
+        second = (int(match[3]), int(match[4] or 1))
+        return cls({}, parent, child, path, first, second)
+
+    def blame_range(self):
+        """Get start and size of the lines to blame in the parent.
+
+        The diff has no context, but a change depends on the lines around it
+        too, so one line before and after the change is included.
+        """
+        start, size = self.first
+        if size == 0:
+            # Pure insertion after line start
+            start += 1
+        start -= 1
+        size += 2
+        if start < 1:
+            size -= 1 - start
+            start = 1
+        return start, size
 
 
 _deletion = object()
 
 
-def parse_hunks(parent, child=None):
-    """Parse hunks in diff."""
-    hunks = []
+def parse_hunks(by_parent_path, parent, child=None):
+    """Parse hunks in diff into by_parent_path."""
     with diff(parent, child) as proc:
-        reader = linereader(proc.stdout)
-        try:
-            # Find hunks
-            path = None
-            while True:
-                line = next(reader)
-                if line.startswith("+++ b/"):
-                    _, _, path = line.partition("+++ b/")
-                    path = path.strip()
-                elif line.startswith("+++ /dev/null"):
-                    # Cannot dig file deletion
-                    path = _deletion
-                elif line.startswith("@@ -") and not path is _deletion:
-                    assert path
-                    hunk = Hunk.from_line(parent, child, path, line)
-                    hunks.append(hunk)
-        except StopIteration:
-            pass
-        return hunks
-
-
-def parse_blame_line(line):
-    """Parse a blame line."""
-    rev, _, rest = line.partition(" ")
-    number, _, _ = rest.partition(")")
-    number = number.strip()
-    try:
-        return rev, int(number)
-    except ValueError:
-        _, _, number = number.rpartition(" ")
-        return rev, int(number)
+        # Find hunks
+        path = None
+        for line in proc.stdout:
+            vprint(line)
+            if line.startswith("+++ b/"):
+                _, _, path = line.partition("+++ b/")
+                path = path.strip()
+            elif line.startswith("+++ /dev/null"):
+                # Cannot dig file deletion
+                path = _deletion
+            elif line.startswith("@@ -") and not path is _deletion:
+                assert path
+                hunk = Hunk.from_line(parent, child, path, line.rstrip("\n"))
+                by_parent_path[(parent, path)].append(hunk)
+
+
+def parse_blame_header(line):
+    """Parse the header of a group in incremental blame output.
+
+    Returns the rev, the first line in the final file and the number of lines.
+    """
+    rev, _, final, count = line.split(b" ")
+    return rev.decode("ascii"), int(final), int(count)
 
 
-def get_blame_line(reader, recover, line_number):
-    """Get a blame line and recover from parser errors."""
-    line = next(reader)
-    # There are lines like this: "ac_cr='^M'", they break the parser, we try
-    # the next line and hope to recover
-    try:
-        rev, number = parse_blame_line(line)
-    except ValueError:
-        wprint(f"broken blame output: '{line}', trying to recover at next line")
-        return True, None, None
-    if recover:
-        wprint(f"recovering with line: '{line}', line_number: {number}")
-        line_number = number
-    else:
-        line_number += 1
-        assert line_number == number
-    return False, line_number, rev
+def find_revs(groups, hunks):
+    """Find revisions in blame groups that overlap the hunks."""
+    groups.sort(key=lambda group: group[1])
+    starts = [first for _, first, _ in groups]
+    for hunk in hunks:
+        start, size = hunk.blame_range()
+        end = start + size
+        index = max(bisect_right(starts, start) - 1, 0)
+        for rev, first, count in groups[index:]:
+            if first >= end:
+                break
+            if first + count > start:
+                hunk.deps[rev] = None
 
 
-def find_revs(stream, hunks):
-    """Find revisions in blame stream."""
-    line_number = 0
-    reader = linereader(stream)
-    try:
-        recover = False
-        for hunk in hunks:
-            lines = hunk.first[0] - line_number - 1
-            for _ in range(lines):
-                recover, line_number, _ = get_blame_line(reader, recover, line_number)
-            hunk_size = hunk.first[1]
-            for _ in range(hunk_size):
-                recover, line_number, rev = get_blame_line(reader, recover, line_number)
-                if not recover:
-                    hunk.deps.add(rev)
-    except StopIteration:
-        pass
+_blame_failed = object()
 
 
-def blame_hunks(hunks):
-    """Blame changes described by hunks."""
-    by_parent_path = defaultdict(list)
-    for hunk in hunks:
-        by_parent_path[(hunk.parent, hunk.path)].append(hunk)
+def read_blame(rev_path, needed):
+    """Read the blame groups of rev/path until all needed lines are covered."""
+    groups = []
+    boundaries = set()
+    needed = set(needed)
     try:
-        for rev_path in by_parent_path.keys():
-            with blame(*rev_path) as proc:
-                find_revs(proc.stdout, by_parent_path[rev_path])
+        with blame(*rev_path) as proc:
+            reader = proc.stdout
+            for header in reader:
+                vprint(header)
+                try:
+                    rev, first, count = parse_blame_header(header)
+                except ValueError:
+                    wprint(f"broken blame output: {header!r}, skipping it")
+                    rev = None
+                # Commit details are only shown the first time a commit appears
+                for line in reader:
+                    vprint(line)
+                    if line == b"boundary\n":
+                        boundaries.add(rev)
+                    elif line.startswith(b"filename "):
+                        break
+                if rev is None:
+                    continue
+                if rev in boundaries:
+                    rev = f"^{rev}"
+                groups.append((rev, first, count))
+                needed.difference_update(range(first, first + count))
+                if not needed:
+                    # We have all lines we need, stop git
+                    proc.stdout.close()
+                    proc.terminate()
+                    break
     except CalledProcessError as e:
-        if e.returncode not in (-13, 128):
+        if e.returncode not in (-13, -15, 128):
             raise
+        if needed:
+            return rev_path, _blame_failed
+    return rev_path, groups
+
+
+@dataclass
+class DigContext:
+    """State shared by the whole dig recursion."""
 
+    executor: ThreadPoolExecutor
+    catfile: CatFile
+    parents_cache: dict[str, tuple[str, ...]] = field(default_factory=dict)
+    seen: set[str] = field(default_factory=set)
 
-def get_parents(base):
+
+@contextmanager
+def dig_context():
+    """Start the worker pool and git cat-file for a dig."""
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        with CatFile() as catfile:
+            yield DigContext(executor, catfile)
+
+
+def blame_hunks(ctx, by_parent_path):
+    """Blame changes described by hunks grouped by (parent, path)."""
+    needed = []
+    for hunks in by_parent_path.values():
+        lines = set()
+        for hunk in hunks:
+            start, size = hunk.blame_range()
+            lines.update(range(start, start + size))
+        needed.append(lines)
+    # Blame in parallel, but only touch the hunks in this thread
+    results = ctx.executor.map(read_blame, by_parent_path.keys(), needed)
+    for rev_path, groups in results:
+        if groups is not _blame_failed:
+            find_revs(groups, by_parent_path[rev_path])
+
+
+def load_parents(ctx, revs):
+    """Load the parents of many commits with one git rev-list."""
+    cache = ctx.parents_cache
+    revs = list(dict.fromkeys(rev for rev in revs if rev not in cache))
+    if not revs:
+        return
+    res = srun(
+        ["git", "rev-list", "--parents", "--no-walk=unsorted", "--stdin"],
+        input="".join(f"{rev}\n" for rev in revs),
+        stdout=PIPE,
+        check=True,
+    )
+    lines = res.stdout.splitlines()
+    # rev-list drops revs that resolve to the same commit, we cannot match
+    # the lines to the revs anymore and let get_parents load them one by one
+    if len(lines) != len(revs):
+        return
+    for rev, line in zip(revs, lines):
+        _, *parents = line.split()
+        cache[rev] = tuple(parents)
+
+
+def get_parents(ctx, base):
     """Get the parents of a commit."""
-    res = srun(["git", "rev-parse", f"{base}^@"], stdout=PIPE, check=True)
-    return [line.strip() for line in res.stdout.splitlines()]
+    cache = ctx.parents_cache
+    if base not in cache:
+        res = srun(["git", "rev-parse", f"{base}^@"], stdout=PIPE, check=True)
+        cache[base] = tuple(line.strip() for line in res.stdout.splitlines())
+    return cache[base]
+
+
+def get_hunks(ctx, parents, child):
+    """Get the blamed hunks of child against parents."""
+    by_parent_path = defaultdict(list)
+    # Each parent only adds its own (parent, path) keys
+    for _ in ctx.executor.map(lambda p: parse_hunks(by_parent_path, p, child), parents):
+        pass
+    blame_hunks(ctx, by_parent_path)
+    # Parents are parsed concurrently, restore the order of the parents
+    order = {parent: index for index, parent in enumerate(parents)}
+    items = sorted(by_parent_path.items(), key=lambda item: order[item[0][0]])
+    return list(chain.from_iterable(hunks for _, hunks in items))
 
 
-def dig(base, max_depth=1, depth=0, seen=None):
+def dig(ctx, base, max_depth=1, depth=0):
     """Compare all parents to the base to find all depending commits."""
-    if not seen:
-        seen = set()
+    seen = ctx.seen
     if depth < max_depth:
         if base == "WORKING":
-            hunks = parse_hunks("HEAD", base)
+            hunks = get_hunks(ctx, ("HEAD",), base)
         else:
-            hunks = []
-            for parent in get_parents(base):
-                hunks += parse_hunks(parent, base)
-        blame_hunks(hunks)
-        depends = OrderedSet()
+            hunks = get_hunks(ctx, get_parents(ctx, base), base)
+        depends = {}
         for hunk in hunks:
-            depends |= hunk.deps
+            depends.update(hunk.deps)
+        # Parents are loaded in one batch per dug commit, not per depth level:
+        # the next level is only known once this level has been diffed and
+        # blamed, and digging breadth-first would dig commits that the
+        # depth-first walk below never follows
+        if depth + 1 < max_depth:
+            load_parents(
+                ctx,
+                (
+                    depend
+                    for depend in depends
+                    if not depend.startswith("^") and depend not in seen
+                ),
+            )
         for depend in depends:
             is_seen = depend in seen
             if depend.startswith("^"):
                 seen.add(depend)
-                print_depend(depend[1:], depth, is_seen)
+                print_depend(ctx.catfile, depend[1:], depth, is_seen)
             else:
-                print_depend(depend, depth, is_seen)
+                print_depend(ctx.catfile, depend, depth, is_seen)
                 if not is_seen:
                     seen.add(depend)
-                    dig(depend, max_depth, depth + 1, seen)
+                    dig(ctx, depend, max_depth, depth + 1)
 
 
 @click.command()
@@ -381,8 +477,11 @@ def main(verbose, base, max_depth):
     """
     init()
     global _devnull
-    global _verbose
+    global vprint
+    global args_print
     if verbose:
         _devnull = None
-        _verbose = True
-    dig(base, max_depth)
+        vprint = print_verbose
+        args_print = print_args
+    with dig_context() as ctx:
+        dig(ctx, base, max_depth)
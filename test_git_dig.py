@@ -0,0 +1,123 @@
+"""Test git_dig."""
+
+import io
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+import git_dig
+from git_dig import Hunk, find_revs, read_blame
+
+_a = "a" * 40
+_b = "b" * 40
+_c = "c" * 40
+
+# Incremental blame of a 6 line file, groups are not in line order
+_blame_output = f"""{_b} 3 3 1
+author b
+summary b
+previous {_a} f.txt
+filename f.txt
+{_a} 1 1 2
+author a
+summary a
+boundary
+filename f.txt
+broken header
+filename f.txt
+{_a} 4 4 2
+filename f.txt
+{_c} 6 6 1
+author c
+summary c
+filename f.txt
+""".encode(
+    "ascii"
+)
+
+
+@pytest.fixture
+def blame_output(monkeypatch):
+    """Let git_dig.blame return canned output."""
+    terminated = []
+
+    @contextmanager
+    def blame(rev, path):
+        proc = SimpleNamespace(
+            stdout=io.BytesIO(_blame_output),
+            terminate=lambda: terminated.append((rev, path)),
+        )
+        yield proc
+
+    monkeypatch.setattr(git_dig, "blame", blame)
+    return terminated
+
+
+def test_read_blame(blame_output):
+    """Boundary applies to all groups of a commit, broken headers are skipped."""
+    rev_path, groups = read_blame(("HEAD", "f.txt"), range(1, 7))
+    assert rev_path == ("HEAD", "f.txt")
+    assert groups == [
+        (_b, 3, 1),
+        (f"^{_a}", 1, 2),
+        (f"^{_a}", 4, 2),
+        (_c, 6, 1),
+    ]
+
+
+def test_read_blame_stop_early(blame_output):
+    """Stop git once all needed lines are covered."""
+    _, groups = read_blame(("HEAD", "f.txt"), {1, 3})
+    assert groups == [(_b, 3, 1), (f"^{_a}", 1, 2)]
+    assert blame_output == [("HEAD", "f.txt")]
+
+
+def test_read_blame_past_end(blame_output):
+    """Lines past the end of the file are never covered, read everything."""
+    _, groups = read_blame(("HEAD", "f.txt"), {6, 7})
+    assert len(groups) == 4
+    assert not blame_output
+
+
+def make_hunk(first):
+    """Create a hunk in the parent at first."""
+    return Hunk({}, "HEAD", "WORKING", "f.txt", first, (1, 1))
+
+
+def test_find_revs_spans_groups(blame_output):
+    """Hunks get the revs of all groups they overlap in line order."""
+    _, groups = read_blame(("HEAD", "f.txt"), range(1, 7))
+    spanning = make_hunk((3, 1))
+    last = make_hunk((6, 1))
+    find_revs(groups, [spanning, last])
+    assert list(spanning.deps) == [f"^{_a}", _b]
+    assert list(last.deps) == [f"^{_a}", _c]
+
+
+@pytest.mark.parametrize(
+    "first, expected",
+    [
+        # Insertion at the top of the file, only the line after it
+        ((0, 0), (1, 1)),
+        # Insertion after the last line (6), the line after does not exist
+        ((6, 0), (6, 2)),
+        # Change of the first line, only the line after it
+        ((1, 1), (1, 2)),
+        # Change in the middle, one line before and after
+        ((3, 2), (2, 4)),
+        # Deletion of the last line
+        ((6, 1), (5, 3)),
+    ],
+)
+def test_blame_range(first, expected):
+    """Blame one line around the change."""
+    assert make_hunk(first).blame_range() == expected
+
+
+def test_blame_range_end_of_file(blame_output):
+    """An insertion at the end of a file depends on the last line."""
+    _, groups = read_blame(("HEAD", "f.txt"), {6, 7})
+    hunk = make_hunk((6, 0))
+    find_revs(groups, [hunk])
+    assert list(hunk.deps) == [_c]